@@ -1,5 +1,5 @@
 import streamlit as st
-from embedder import get_embedding
+from embedder import get_embedding, get_embeddings_batch
 from qdrant_utils import get_qdrant_client, create_collection, upload_documents, search_documents
 from generator import generate_code
 
@@ -14,9 +14,9 @@ st.header("Upload Reference Documents")
 uploaded_files = st.file_uploader("Upload .txt or .md files", accept_multiple_files=True)
 if uploaded_files and QDRANT_URL and QDRANT_API_KEY and OPENAI_API_KEY:
     docs = [f.read().decode("utf-8") for f in uploaded_files]
-    embeddings = [get_embedding(doc, OPENAI_API_KEY) for doc in docs]
+    embeddings = get_embeddings_batch(docs, OPENAI_API_KEY, batch_size=100)
     client = get_qdrant_client(QDRANT_URL, QDRANT_API_KEY)
-    create_collection(client, COLLECTION_NAME, len(embeddings[0]))
+    create_collection(client, COLLECTION_NAME, embeddings.shape[1])
     upload_documents(client, COLLECTION_NAME, docs, embeddings)
     st.success("Documents embedded and stored!")
 
@@ -1,33 +1,59 @@
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import StreamingResponse
-from embedder import extract_text_with_pages, get_embedding, get_embeddings_batch
-from document_processor import clean_text, chunk_by_sentences, create_chunk_with_metadata
-from qdrant_utils import get_qdrant_client, create_collection, upload_documents_with_metadata, search_documents_with_metadata
-from generator import generate_code, generate_code_stream
+from embedder import extract_text_with_pages, get_query_embedding, aget_embeddings_batch
+from document_processor import chunk_pages_by_sentences, create_chunk_with_metadata
+from qdrant_utils import get_qdrant_client, create_collection, upload_documents_with_metadata, search_documents, search_documents_with_metadata
+from generator import agenerate_code, agenerate_code_stream, close_http_session
+from chunk_cache import generation_cache_key, get_cached_generation, store_generation
 
-from prompt import build_prompt
+from prompt import build_context, build_strict_prompt, truncate_context
 import os
+import asyncio
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import time
-import json
+import orjson
+import numpy as np
+from contextlib import asynccontextmanager
 from datetime import datetime
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(f'rag_pipeline_{datetime.now().strftime("%Y%m%d")}.log'),
-        logging.StreamHandler()
-    ]
-)
+# Configure logging: request handlers only enqueue records; a background listener thread does the file/console I/O
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_handler = logging.FileHandler(f'rag_pipeline_{datetime.now().strftime("%Y%m%d")}.log')
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+
+# The queue carries the bare message; the listener's handlers apply log_formatter once
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Started per lifespan (not at import) so a restarted app, e.g. under TestClient or reload, logs again
+    log_listener.start()
+    # One Qdrant client for the whole process; gRPC keeps a persistent channel open
+    app.state.qdrant = get_qdrant_client(QDRANT_URL, QDRANT_API_KEY)
+    yield
+    app.state.qdrant.close()
+    get_qdrant_client.cache_clear()
+    logger.info("Qdrant client closed")
+    await close_http_session()
+    # Flush any queued log records before exit
+    log_listener.stop()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -35,86 +61,65 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compresses the JSON responses; Starlette leaves text/event-stream uncompressed so SSE frames flush immediately
+app.add_middleware(GZipMiddleware, minimum_size=1000)
 
 QDRANT_URL = os.getenv("QDRANT_URL")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 COLLECTION_NAME = "reference_docs"
 
-@app.post("/upload")
-async def upload_docs(files: list[UploadFile] = File(...)):
+# Cap on files processed concurrently by /upload
+MAX_CONCURRENT_FILES = 4
+
+
+async def process_file(file: UploadFile, file_idx: int, total_files: int, semaphore: asyncio.Semaphore):
     """
-    Complete RAG pipeline: Extract → Clean → Chunk → Embed → Store
+    Run Extract → Clean → Chunk → Embed for a single uploaded file.
+    Returns (chunk_objs, embeddings, progress_log, timing), or empty results if the file is skipped.
     """
-    pipeline_start = time.time()
-    logger.info(f"========== Starting document upload pipeline ==========")
-    logger.info(f"Received {len(files)} files for processing")
-    
-    if not files:
-        logger.warning("No files provided in request")
-        return {"status": "error", "message": "No files provided"}
-    
-    client_start = time.time()
-    client = get_qdrant_client(QDRANT_URL, QDRANT_API_KEY)
-    client_time = time.time() - client_start
-    logger.info(f"Qdrant client initialized successfully (took {client_time:.2f}s)")
-    
-    all_chunk_objs = []
-    all_embeddings = []
-    progress_log = []
-    timing_info = {}
-    
-    for file_idx, file in enumerate(files, 1):
+    async with semaphore:
         file_start = time.time()
-        logger.info(f"[{file_idx}/{len(files)}] Processing file: {file.filename}")
-        progress_log.append(f"[{file_idx}/{len(files)}] Processing: {file.filename}")
+        progress_log = []
+        logger.info(f"[{file_idx}/{total_files}] Processing file: {file.filename}")
+        progress_log.append(f"[{file_idx}/{total_files}] Processing: {file.filename}")
         
-        # Read file
-        read_start = time.time()
-        file_bytes = await file.read()
-        read_time = time.time() - read_start
-        file_size_mb = len(file_bytes) / (1024 * 1024)
-        logger.info(f"  → File size: {file_size_mb:.2f} MB (read took {read_time:.2f}s)")
+        # Starlette has already spooled the upload to a SpooledTemporaryFile (disk-backed past 1 MB),
+        # so hand that stream to the parser instead of copying the whole file onto the heap
+        file_size = file.size
+        if file_size is None:
+            file.file.seek(0, os.SEEK_END)
+            file_size = file.file.tell()
+        file_size_mb = file_size / (1024 * 1024)
+        logger.info(f"  → File size: {file_size_mb:.2f} MB")
         progress_log.append(f"  → File size: {file_size_mb:.2f} MB")
         
-        # Step 1: Extract with page information
+        # Step 1: Extract with page information (CPU-bound, keep it off the event loop)
         extract_start = time.time()
         logger.info(f"  → Step 1: Extracting text from {file.filename}")
         progress_log.append(f"  → Extracting text with page tracking...")
-        raw_text, page_texts = extract_text_with_pages(file_bytes, file.filename)
+        raw_text, page_texts = await asyncio.to_thread(extract_text_with_pages, file.file, file.filename)
         extract_time = time.time() - extract_start
         
         if not raw_text:
             logger.warning(f"  ✗ No text extracted from {file.filename}, skipping")
             progress_log.append(f"  ✗ Failed to extract text, skipping")
-            continue
+            return [], [], progress_log, None
         
         logger.info(f"  ✓ Extracted {len(raw_text)} characters from {len(page_texts)} pages (took {extract_time:.2f}s)")
         progress_log.append(f"  ✓ Extracted {len(raw_text)} characters from {len(page_texts)} pages in {extract_time:.2f}s")
         
-        # Step 2: Process each page separately for better citation tracking
+        # Step 2: Clean and chunk all pages in one pass, keeping page numbers for citation tracking
         chunk_start = time.time()
         logger.info(f"  → Step 2-3: Processing {len(page_texts)} pages into chunks")
         progress_log.append(f"  → Processing pages into chunks...")
-        
-        page_chunks = []
-        for page_num, page_text in page_texts:
-            # Clean page text
-            cleaned_page = clean_text(page_text)
-            if not cleaned_page:
-                continue
-            
-            # Chunk page with semantic boundaries
-            chunks = chunk_by_sentences(cleaned_page, chunk_size=500, overlap=50)
-            for chunk in chunks:
-                page_chunks.append((page_num, chunk))
-        
+        page_chunks = await asyncio.to_thread(chunk_pages_by_sentences, page_texts, 500, 50)
         chunk_time = time.time() - chunk_start
         
         if not page_chunks:
             logger.warning(f"  ✗ No chunks created from {file.filename}, skipping")
             progress_log.append(f"  ✗ Failed to create chunks, skipping")
-            continue
+            return [], [], progress_log, None
         
         logger.info(f"  ✓ Created {len(page_chunks)} chunks from {len(page_texts)} pages (took {chunk_time:.2f}s)")
         progress_log.append(f"  ✓ Created {len(page_chunks)} chunks in {chunk_time:.2f}s")
@@ -134,28 +139,23 @@ async def upload_docs(files: list[UploadFile] = File(...)):
             chunk_texts.append(chunk)
         
         # BATCH EMBEDDING - This is the key optimization!
-        # Instead of 300 sequential API calls, we make 3 batch calls
+        # Instead of 300 sequential API calls, we make 3 batch calls, all in flight at once;
+        # chunks already in the on-disk embedding cache skip the API, and repeated chunks are embedded once
         logger.info(f"  → Generating {len(chunk_texts)} embeddings in batches (100 per call)")
-        file_embeddings = get_embeddings_batch(chunk_texts, OPENAI_API_KEY, batch_size=100)
-        
-        # Add to global lists
-        all_chunk_objs.extend(file_chunk_objs)
-        all_embeddings.extend(file_embeddings)
+        file_embeddings = await aget_embeddings_batch(chunk_texts, OPENAI_API_KEY, batch_size=100)
         
         embed_time = time.time() - embed_start
         embeddings_per_sec = len(page_chunks) / embed_time if embed_time > 0 else 0
         logger.info(f"  ✓ Generated {len(page_chunks)} embeddings (took {embed_time:.2f}s, {embeddings_per_sec:.1f} embeddings/sec)")
         progress_log.append(f"  ✓ Batch generated {len(page_chunks)} embeddings in {embed_time:.2f}s ({embeddings_per_sec:.1f}/sec)")
-
         
         file_total_time = time.time() - file_start
         logger.info(f"  → Total time for {file.filename}: {file_total_time:.2f}s")
         progress_log.append(f"  → Total: {file_total_time:.2f}s")
         
         # Store timing for this file
-        timing_info[file.filename] = {
+        timing = {
             "file_size_mb": file_size_mb,
-            "read_time": read_time,
             "extract_time": extract_time,
             "chunk_time": chunk_time,
             "embed_time": embed_time,
@@ -164,8 +164,53 @@ async def upload_docs(files: list[UploadFile] = File(...)):
             "pages_extracted": len(page_texts),
             "chars_extracted": len(raw_text)
         }
+        return file_chunk_objs, file_embeddings, progress_log, timing
+
+
+@app.post("/upload")
+async def upload_docs(files: list[UploadFile] = File(...)):
+    """
+    Complete RAG pipeline: Extract → Clean → Chunk → Embed → Store
+    Files are processed concurrently (up to MAX_CONCURRENT_FILES at a time).
+    """
+    pipeline_start = time.time()
+    logger.info(f"========== Starting document upload pipeline ==========")
+    logger.info(f"Received {len(files)} files for processing")
+    
+    if not files:
+        logger.warning("No files provided in request")
+        return {"status": "error", "message": "No files provided"}
     
-    if not all_embeddings:
+    all_chunk_objs = []
+    progress_log = []
+    timing_info = {}
+    
+    # Overlap CPU-bound extraction of one file with embedding HTTP latency of another
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
+    results = await asyncio.gather(*[
+        process_file(file, file_idx, len(files), semaphore)
+        for file_idx, file in enumerate(files, 1)
+    ])
+    
+    embedded = [r for r in results if r[3] is not None]
+    total_chunks = sum(len(file_embeddings) for _, file_embeddings, _, _ in embedded)
+    embedding_dim = embedded[0][1].shape[1] if embedded else 0
+    
+    # One contiguous float32 matrix for all files, filled slice by slice
+    all_embeddings = np.empty((total_chunks, embedding_dim), dtype=np.float32)
+    offset = 0
+    
+    # gather() preserves input order, so chunk/point ordering stays deterministic
+    for file, (file_chunk_objs, file_embeddings, file_progress, file_timing) in zip(files, results):
+        progress_log.extend(file_progress)
+        if file_timing is None:
+            continue
+        all_chunk_objs.extend(file_chunk_objs)
+        all_embeddings[offset:offset + len(file_embeddings)] = file_embeddings
+        offset += len(file_embeddings)
+        timing_info[file.filename] = file_timing
+    
+    if total_chunks == 0:
         logger.error("No valid content found in any uploaded files")
         return {"status": "error", "message": "No valid content found in uploaded files", "progress": progress_log}
     
@@ -173,8 +218,9 @@ async def upload_docs(files: list[UploadFile] = File(...)):
     store_start = time.time()
     logger.info(f"→ Step 6: Storing {len(all_chunk_objs)} chunks in Qdrant")
     progress_log.append(f"→ Storing {len(all_chunk_objs)} chunks in Qdrant...")
-    create_collection(client, COLLECTION_NAME, len(all_embeddings[0]))
-    upload_documents_with_metadata(client, COLLECTION_NAME, all_chunk_objs, all_embeddings)
+    client = app.state.qdrant
+    await asyncio.to_thread(create_collection, client, COLLECTION_NAME, embedding_dim)
+    await asyncio.to_thread(upload_documents_with_metadata, client, COLLECTION_NAME, all_chunk_objs, all_embeddings)
     store_time = time.time() - store_start
     logger.info(f"✓ Successfully uploaded {len(all_chunk_objs)} chunks to collection '{COLLECTION_NAME}' (took {store_time:.2f}s)")
     progress_log.append(f"✓ Successfully stored all chunks in {store_time:.2f}s!")
@@ -185,7 +231,6 @@ async def upload_docs(files: list[UploadFile] = File(...)):
     # Add timing summary
     timing_summary = {
         "total_pipeline_time": round(pipeline_total_time, 2),
-        "qdrant_client_init": round(client_time, 2),
         "vector_store_time": round(store_time, 2),
         "files": timing_info
     }
@@ -206,29 +251,22 @@ async def generate(query: str = Form(...), top_k: int = Form(5), conversation_hi
     logger.info(f"========== Starting code generation pipeline ==========")
     logger.info(f"Query: {query[:100]}...")
     
-    # Parse conversation history if provided
-    history_context = ""
     if conversation_history:
         logger.info(f"Including conversation history ({len(conversation_history)} chars)")
-        history_context = f"\n\nPrevious Conversation Context:\n{conversation_history}\n"
     
     progress_log = []
     
-    logger.info("→ Step 1: Connecting to Qdrant")
-    progress_log.append("→ Connecting to Qdrant...")
-    client = get_qdrant_client(QDRANT_URL, QDRANT_API_KEY)
-    logger.info("✓ Qdrant client connected")
-    progress_log.append("✓ Connected to Qdrant")
+    client = app.state.qdrant
     
-    logger.info("→ Step 2: Generating query embedding")
+    logger.info("→ Step 1: Generating query embedding")
     progress_log.append("→ Generating query embedding...")
-    query_embedding = get_embedding(query, OPENAI_API_KEY)
+    query_embedding = await asyncio.to_thread(get_query_embedding, query, OPENAI_API_KEY)
     logger.info(f"✓ Query embedding generated (dimension: {len(query_embedding)})")
     progress_log.append(f"✓ Query embedding generated")
     
-    logger.info(f"→ Step 3: Searching for top {top_k} relevant documents")
+    logger.info(f"→ Step 2: Searching for top {top_k} relevant documents")
     progress_log.append(f"→ Searching for top {top_k} relevant documents...")
-    search_results = search_documents_with_metadata(client, COLLECTION_NAME, query_embedding, top_k)
+    search_results = await asyncio.to_thread(search_documents_with_metadata, client, COLLECTION_NAME, query_embedding, top_k)
     
     if not search_results:
         logger.warning("✗ No documents found in collection")
@@ -248,57 +286,34 @@ async def generate(query: str = Form(...), top_k: int = Form(5), conversation_hi
         page_info = f"page {result['page_number']}" if result['page_number'] else f"chunk {result['chunk_index']}"
         logger.info(f"  Source {i}: {result['source']} ({page_info}) - relevance: {result['score']:.4f}")
     
-    logger.info("→ Step 4: Building context from retrieved documents")
+    logger.info("→ Step 3: Building context from retrieved documents")
     progress_log.append("→ Building context with citations...")
     
     # Build context with source markers
-    context_parts = []
-    for i, result in enumerate(search_results, 1):
-        page_info = f"Page {result['page_number']}" if result['page_number'] else f"Chunk {result['chunk_index']}"
-        context_parts.append(f"[Source {i}: {result['source']} - {page_info}]\n{result['text']}")
-    
-    context = "\n\n---\n\n".join(context_parts)
+    context = truncate_context(build_context(search_results))
     logger.info(f"✓ Context built with {len(search_results)} sources ({len(context)} characters)")
     progress_log.append(f"✓ Context built with {len(search_results)} sources")
     
-    logger.info("→ Step 5: Building strict grounded prompt")
+    logger.info("→ Step 4: Building strict grounded prompt")
     progress_log.append("→ Building strict grounded prompt...")
     
     # Create strict anti-hallucination prompt with conversation context
-    strict_prompt = f"""You are a precise code generation assistant. You MUST follow these rules strictly:
-
-1. ONLY use information from the provided reference documents
-2. DO NOT add any information not present in the references
-3. If the references don't contain enough information, say "The provided documentation does not contain sufficient information for..."
-4. When generating code, cite which source number [Source N] you're using
-5. Include comments in code indicating which source the logic comes from
-6. If this is a follow-up question, consider the previous conversation context but still ground responses in the reference documents
-
-{history_context}
-Reference Documents:
-{context}
-
-User Query:
-{query}
-
-Instructions:
-- Generate code based ONLY on the reference documents above
-- Add comments like "# Based on Source 1: filename.pdf - Page X"
-- If multiple approaches are mentioned in different sources, mention all of them
-- If information is missing, explicitly state what's missing
-- Include inline citations in comments
-- For follow-up questions, maintain context from the previous conversation while staying grounded in the documents
-
-Generate the code with citations:"""
+    strict_prompt = build_strict_prompt(context, query, conversation_history)
     
     logger.info(f"✓ Strict prompt built ({len(strict_prompt)} characters)")
     progress_log.append("✓ Strict anti-hallucination prompt ready")
     
-    logger.info("→ Step 6: Generating grounded code with GPT-4")
+    logger.info("→ Step 5: Generating grounded code with GPT-4")
     progress_log.append("→ Generating grounded code with GPT-4...")
     
     # Generate with strict parameters to reduce hallucination
-    code = generate_code(context, strict_prompt, OPENAI_API_KEY)
+    cache_key = generation_cache_key(strict_prompt)
+    code = get_cached_generation(cache_key)
+    if code is not None:
+        logger.info("✓ Reusing cached generation for identical query and sources")
+    else:
+        code = await agenerate_code(context, query, OPENAI_API_KEY, prompt=strict_prompt)
+        store_generation(cache_key, code)
     logger.info(f"✓ Code generated ({len(code)} characters)")
     progress_log.append(f"✓ Code generated with citations!")
     
@@ -312,7 +327,7 @@ Generate the code with citations:"""
             "location": page_info,
             "page_number": result['page_number'],
             "chunk_index": result['chunk_index'],
-            "relevance_score": result['score'],
+            "relevance_score": round(result['score'], 4),
             "excerpt": result['text'][:300] + "..." if len(result['text']) > 300 else result['text']
         })
     
@@ -325,6 +340,14 @@ Generate the code with citations:"""
         "num_sources": len(sources)
     }
 
+# Preformatted frame for the per-token 'code' events; only the content string is serialized
+SSE_CODE_PREFIX = b'data: {"type":"code","content":'
+SSE_CODE_SUFFIX = b'}\n\n'
+
+def sse_event(payload: dict) -> bytes:
+    """Serialize a payload as a Server-Sent Events data frame."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
 # Streaming endpoint for real-time code generation
 @app.post("/generate-stream")
 async def generate_stream(
@@ -341,22 +364,19 @@ async def generate_stream(
     
     async def event_generator():
         try:
-            # Step 1: Connect to Qdrant
-            yield f"data: {json.dumps({'type': 'status', 'message': 'Connecting to Qdrant...'})}\n\n"
-            client = get_qdrant_client(QDRANT_URL, QDRANT_API_KEY)
-            logger.info("✓ Qdrant client connected")
+            client = app.state.qdrant
             
-            # Step 2: Generate query embedding
-            yield f"data: {json.dumps({'type': 'status', 'message': 'Generating query embedding...'})}\n\n"
-            query_embedding = get_embedding(query, OPENAI_API_KEY)
+            # Step 1: Generate query embedding
+            yield sse_event({'type': 'status', 'message': 'Generating query embedding...'})
+            query_embedding = await asyncio.to_thread(get_query_embedding, query, OPENAI_API_KEY)
             logger.info("✓ Query embedding generated")
             
-            # Step 3: Search for relevant documents
-            yield f"data: {json.dumps({'type': 'status', 'message': f'Searching for top {top_k} relevant documents...'})}\n\n"
-            search_results = search_documents_with_metadata(client, COLLECTION_NAME, query_embedding, top_k=top_k)
+            # Step 2: Search for relevant documents
+            yield sse_event({'type': 'status', 'message': f'Searching for top {top_k} relevant documents...'})
+            search_results = await asyncio.to_thread(search_documents_with_metadata, client, COLLECTION_NAME, query_embedding, top_k)
             
             if not search_results:
-                yield f"data: {json.dumps({'type': 'error', 'message': 'No documents found. Please upload reference documents first.'})}\n\n"
+                yield sse_event({'type': 'error', 'message': 'No documents found. Please upload reference documents first.'})
                 return
             
             logger.info(f"✓ Found {len(search_results)} relevant document chunks")
@@ -371,67 +391,34 @@ async def generate_stream(
                     "location": page_info,
                     "page_number": result['page_number'],
                     "chunk_index": result['chunk_index'],
-                    "relevance_score": result['score'],
+                    "relevance_score": round(result['score'], 4),
                     "excerpt": result['text'][:300] + "..." if len(result['text']) > 300 else result['text']
                 })
             
-            yield f"data: {json.dumps({'type': 'sources', 'sources': sources})}\n\n"
+            yield sse_event({'type': 'sources', 'sources': sources})
             
-            # Step 4: Build context
-            yield f"data: {json.dumps({'type': 'status', 'message': 'Building context from retrieved documents...'})}\n\n"
-            context_parts = []
-            for i, result in enumerate(search_results, 1):
-                page_info = f"Page {result['page_number']}" if result['page_number'] else f"Chunk {result['chunk_index']}"
-                context_parts.append(f"[Source {i}: {result['source']} - {page_info}]\n{result['text']}")
-            
-            context = "\n\n---\n\n".join(context_parts)
+            # Step 3: Build context
+            yield sse_event({'type': 'status', 'message': 'Building context from retrieved documents...'})
+            context = truncate_context(build_context(search_results))
             logger.info(f"✓ Context built with {len(search_results)} sources")
             
-            # Step 5: Build prompt
-            history_context = ""
-            if conversation_history.strip():
-                history_context = f"Previous Conversation Context:\n{conversation_history}\n\n"
-            
-            strict_prompt = f"""You are a precise code generation assistant. You MUST follow these rules strictly:
-
-1. ONLY use information from the provided reference documents
-2. DO NOT add any information not present in the references
-3. If the references don't contain enough information, say "The provided documentation does not contain sufficient information for..."
-4. When generating code, cite which source number [Source N] you're using
-5. Include comments in code indicating which source the logic comes from
-6. If this is a follow-up question, consider the previous conversation context but still ground responses in the reference documents
-
-{history_context}
-Reference Documents:
-{context}
-
-User Query:
-{query}
-
-Instructions:
-- Generate code based ONLY on the reference documents above
-- Add comments like "# Based on Source 1: filename.pdf - Page X"
-- If multiple approaches are mentioned in different sources, mention all of them
-- If information is missing, explicitly state what's missing
-- Include inline citations in comments
-- For follow-up questions, maintain context from the previous conversation while staying grounded in the documents
-
-Generate the code with citations:"""
+            # Step 4: Build prompt
+            strict_prompt = build_strict_prompt(context, query, conversation_history)
             
-            # Step 6: Stream code generation
-            yield f"data: {json.dumps({'type': 'status', 'message': 'Generating code with GPT-4...'})}\n\n"
+            # Step 5: Stream code generation
+            yield sse_event({'type': 'status', 'message': 'Generating code with GPT-4...'})
             
-            # Stream the code chunks
-            for code_chunk in generate_code_stream(context, strict_prompt, OPENAI_API_KEY):
-                yield f"data: {json.dumps({'type': 'code', 'content': code_chunk})}\n\n"
+            # Stream the code chunks straight from the async OpenAI stream
+            async for code_chunk in agenerate_code_stream(context, query, OPENAI_API_KEY, prompt=strict_prompt):
+                yield SSE_CODE_PREFIX + orjson.dumps(code_chunk) + SSE_CODE_SUFFIX
             
             # Send completion signal
-            yield f"data: {json.dumps({'type': 'done', 'message': 'Code generation completed!'})}\n\n"
+            yield sse_event({'type': 'done', 'message': 'Code generation completed!'})
             logger.info("✓ Streaming code generation completed")
             
         except Exception as e:
             logger.error(f"Error in streaming: {str(e)}")
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+            yield sse_event({'type': 'error', 'message': str(e)})
     
     return StreamingResponse(
         event_generator(),
@@ -439,6 +426,8 @@ Generate the code with citations:"""
         headers={
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
+            # Stop nginx-style reverse proxies from buffering the stream
+            "X-Accel-Buffering": "no",
         }
     )
 
@@ -457,9 +446,9 @@ async def agentic_workflow(
     logger.info(f"Query: {query[:100]}...")
     
     logger.info("→ Retrieving relevant context")
-    client = get_qdrant_client(QDRANT_URL, QDRANT_API_KEY)
-    query_embedding = get_embedding(query, OPENAI_API_KEY)
-    top_docs = search_documents(client, COLLECTION_NAME, query_embedding)
+    client = app.state.qdrant
+    query_embedding = await asyncio.to_thread(get_query_embedding, query, OPENAI_API_KEY)
+    top_docs = await asyncio.to_thread(search_documents, client, COLLECTION_NAME, query_embedding)
     
     if not top_docs:
         logger.warning("✗ No documents found for agentic workflow")
@@ -467,7 +456,7 @@ async def agentic_workflow(
     
     logger.info(f"✓ Retrieved {len(top_docs)} relevant chunks")
     
-    context = "\n\n".join(top_docs)
+    context = truncate_context("\n\n".join(top_docs))
     scenario_instructions = {
         "bug_fix": "Focus on identifying and fixing the bug described. Output only the corrected code and a brief comment explaining the fix.",
         "migration": "Provide code to migrate from the old system or API to the new one. Highlight changes and ensure compatibility.",
@@ -479,7 +468,7 @@ async def agentic_workflow(
     prompt = f"Reference:\n{context}\n\nInstruction:\n{query}\n\nScenario:\n{scenario}\n\n{scenario_text}\n"
     
     logger.info("→ Generating code with agentic approach")
-    code = generate_code(context, prompt, OPENAI_API_KEY)
+    code = await agenerate_code(context, query, OPENAI_API_KEY, prompt=prompt)
     logger.info(f"✓ Agentic code generated ({len(code)} characters)")
     logger.info(f"========== Agentic workflow completed ==========")
     
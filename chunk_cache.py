@@ -0,0 +1,179 @@
+"""
+Content-addressed caches for the RAG pipeline.
+Embeddings are persisted in an on-disk SQLite LRU keyed by SHA-256(model, dim, text), so
+re-indexing the same pages skips the OpenAI call. Generated code is kept in a
+short-lived in-memory cache keyed by the full prompt (retrieved chunks, their labels and the query).
+Search results are kept in a small similarity-keyed cache so near-duplicate questions skip the
+vector search.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.db")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "10000"))
+GENERATION_CACHE_TTL = 300  # seconds
+SEARCH_CACHE_TTL = 60  # seconds
+
+_generation_cache = {}
+_generation_lock = threading.Lock()
+
+def content_hash(text: str) -> str:
+    """Stable hash of a chunk's text."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+class EmbeddingCache:
+    """
+    Disk-backed LRU of embedding vectors stored as raw float32 bytes.
+    Each call opens its own SQLite connection, so the cache is safe to use from worker threads.
+    """
+    
+    def __init__(self, path: str, max_entries: int = 10_000):
+        self.path = path
+        self.max_entries = max_entries
+    
+    @staticmethod
+    def key(model: str, dim: int, text: str) -> bytes:
+        """Cache key for one input; the dimension is included so a resized model never serves old vectors."""
+        return hashlib.sha256(f"{model}:{dim}\0{text}".encode("utf-8")).digest()
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS emb (key BLOB PRIMARY KEY, model TEXT, vec BLOB, ts INTEGER)")
+        conn.execute("CREATE INDEX IF NOT EXISTS emb_ts ON emb (ts)")
+        return conn
+    
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """Return {key: embedding} for every key already cached, marking hits as recently used."""
+        if not keys:
+            return {}
+        found = {}
+        unique = list(set(keys))
+        conn = self._connect()
+        try:
+            with conn:
+                # Stay well under SQLite's bound-parameter limit
+                for i in range(0, len(unique), 500):
+                    part = unique[i:i + 500]
+                    placeholders = ",".join("?" * len(part))
+                    rows = conn.execute(f"SELECT key, vec FROM emb WHERE key IN ({placeholders})", part).fetchall()
+                    for key, blob in rows:
+                        found[key] = np.frombuffer(blob, dtype=np.float32)
+                    if rows:
+                        conn.execute(f"UPDATE emb SET ts = ? WHERE key IN ({placeholders})", [time.time_ns(), *part])
+        finally:
+            conn.close()
+        logger.debug(f"Embedding cache: {len(found)}/{len(unique)} hits")
+        return found
+    
+    def put_many(self, model: str, entries: Dict[bytes, np.ndarray]):
+        """Persist {key: embedding} and evict least recently used rows. Zero-vector fallbacks are not cached."""
+        now = time.time_ns()
+        rows = [(key, model, np.asarray(vec, dtype=np.float32).tobytes(), now) for key, vec in entries.items() if np.any(vec)]
+        if not rows:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO emb (key, model, vec, ts) VALUES (?, ?, ?, ?)", rows)
+                (count,) = conn.execute("SELECT COUNT(*) FROM emb").fetchone()
+                if count > self.max_entries:
+                    conn.execute(
+                        "DELETE FROM emb WHERE key IN (SELECT key FROM emb ORDER BY ts LIMIT ?)",
+                        (count - self.max_entries,)
+                    )
+                    logger.debug(f"Embedding cache: evicted {count - self.max_entries} entries")
+        finally:
+            conn.close()
+        logger.debug(f"Embedding cache: stored {len(rows)} embeddings")
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES)
+
+def generation_cache_key(prompt: str) -> str:
+    """
+    Key generated output by the full prompt: retrieved context in order with its source labels,
+    plus the query and history, so cached [Source N] citations always match the sources returned.
+    """
+    return content_hash(prompt)
+
+def get_cached_generation(key: str) -> Optional[str]:
+    with _generation_lock:
+        entry = _generation_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, code = entry
+        if expires_at < time.time():
+            del _generation_cache[key]
+            return None
+        return code
+
+def store_generation(key: str, code: str):
+    now = time.time()
+    with _generation_lock:
+        # Drop expired entries so the cache can't grow without bound
+        for k in [k for k, (expires_at, _) in _generation_cache.items() if expires_at < now]:
+            del _generation_cache[k]
+        _generation_cache[key] = (now + GENERATION_CACHE_TTL, code)
+
+class SearchResultCache:
+    """
+    In-memory LRU of search results keyed by query embedding.
+    A lookup hits when a cached query's cosine similarity is at least `threshold`, so rephrasings
+    of the same question reuse the earlier results. Entries expire after `ttl` seconds, which bounds
+    how long results from before a re-index (possibly done by another process) can be served.
+    """
+    
+    def __init__(self, max_entries: int = 512, threshold: float = 0.97, ttl: float = SEARCH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self._entries = OrderedDict()  # id -> (unit vector, top_k, results, expires_at)
+        self._next_id = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _unit(embedding) -> np.ndarray:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+    
+    def _drop_expired(self):
+        now = time.time()
+        for k in [k for k, entry in self._entries.items() if entry[3] < now]:
+            del self._entries[k]
+    
+    def get(self, embedding, top_k: int) -> Optional[list]:
+        """Return cached results for the closest earlier query, or None below the threshold."""
+        with self._lock:
+            self._drop_expired()
+            if not self._entries:
+                return None
+            ids = list(self._entries)
+            matrix = np.stack([self._entries[i][0] for i in ids])
+            scores = matrix @ self._unit(embedding)
+            # Only entries fetched with at least as many results can answer this query
+            for idx in np.argsort(scores)[::-1]:
+                if scores[idx] < self.threshold:
+                    break
+                _, cached_top_k, results, _ = self._entries[ids[idx]]
+                if cached_top_k >= top_k:
+                    self._entries.move_to_end(ids[idx])
+                    logger.debug(f"Search cache hit (similarity {scores[idx]:.4f})")
+                    return results[:top_k]
+            return None
+    
+    def put(self, embedding, top_k: int, results: list):
+        with self._lock:
+            self._drop_expired()
+            self._entries[self._next_id] = (self._unit(embedding), top_k, results, time.time() + self.ttl)
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -2,65 +2,122 @@
 Document processing utilities for RAG pipeline
 """
 import re
+import string
 import logging
-from typing import List, Dict
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import List, Dict, Tuple
 
 logger = logging.getLogger(__name__)
 
+_WS_RE = re.compile(r'\s+')
+_DROP_RE = re.compile(r'[^\w\s\.\,\!\?\-\:\;\(\)]')
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+
+# ASCII fast path for clean_text: str.translate deletes everything outside _KEEP in a single C loop
+_KEEP = frozenset(string.ascii_letters + string.digits + "_.,!?-:;()")
+_DROP_TBL = str.maketrans('', '', ''.join(chr(c) for c in range(128) if chr(c) not in _KEEP and not chr(c).isspace()))
+
 def clean_text(text: str) -> str:
     """Clean and normalize text."""
+    if not text or text.isspace():
+        return ""
     logger.debug(f"Cleaning text of length {len(text)}")
-    # Remove extra whitespace
-    text = re.sub(r'\s+', ' ', text)
     # Remove special characters but keep punctuation
-    text = re.sub(r'[^\w\s\.\,\!\?\-\:\;\(\)]', '', text)
-    cleaned = text.strip()
+    if text.isascii():
+        text = text.translate(_DROP_TBL)
+    else:
+        text = _DROP_RE.sub('', text)
+    # Remove extra whitespace
+    cleaned = _WS_RE.sub(' ', text).strip()
     logger.debug(f"Cleaned text length: {len(cleaned)}")
     return cleaned
 
-def chunk_by_sentences(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
+def _sentence_windows(sentences: List[str], chunk_size: int, overlap: int) -> List[Tuple[int, int]]:
     """
-    Chunk text by sentences to preserve semantic meaning.
+    Group sentences into chunks, returning (lo, hi) index pairs so each chunk is sentences[lo:hi].
+    Uses prefix sums of sentence lengths so each overlap lookup is a bisect instead of a backward scan.
     """
-    logger.debug(f"Chunking text of length {len(text)} with chunk_size={chunk_size}, overlap={overlap}")
-    # Split by sentence endings
-    sentences = re.split(r'(?<=[.!?])\s+', text)
-    logger.debug(f"Split into {len(sentences)} sentences")
+    # cum[i] = total length of sentences[:i]
+    cum = [0]
+    cum.extend(accumulate(len(s) for s in sentences))
     
-    chunks = []
-    current_chunk = []
-    current_length = 0
+    windows = []
+    lo = 0  # current chunk is sentences[lo:hi]
     
-    for sentence in sentences:
-        sentence_length = len(sentence)
-        
-        if current_length + sentence_length > chunk_size and current_chunk:
+    for hi in range(len(sentences)):
+        if cum[hi + 1] - cum[lo] > chunk_size and hi > lo:
             # Save current chunk
-            chunks.append(' '.join(current_chunk))
+            windows.append((lo, hi))
             
-            # Start new chunk with overlap
-            overlap_sentences = []
-            overlap_length = 0
-            for s in reversed(current_chunk):
-                if overlap_length + len(s) <= overlap:
-                    overlap_sentences.insert(0, s)
-                    overlap_length += len(s)
-                else:
-                    break
-            
-            current_chunk = overlap_sentences
-            current_length = overlap_length
-        
-        current_chunk.append(sentence)
-        current_length += sentence_length
+            # Start new chunk with the longest sentence suffix that fits in the overlap
+            lo = bisect_left(cum, cum[hi] - overlap, lo, hi + 1)
     
     # Add remaining chunk
-    if current_chunk:
-        chunks.append(' '.join(current_chunk))
+    if lo < len(sentences):
+        windows.append((lo, len(sentences)))
+    return windows
+
+def chunk_by_sentences(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
+    """
+    Chunk text by sentences to preserve semantic meaning.
+    """
+    if not text or text.isspace():
+        return []
+    # Text that fits in one chunk would come back unchanged, so skip sentence splitting
+    if len(text) <= chunk_size:
+        return [text]
+    
+    logger.debug(f"Chunking text of length {len(text)} with chunk_size={chunk_size}, overlap={overlap}")
+    # Split by sentence endings
+    sentences = _SENT_RE.split(text)
+    logger.debug(f"Split into {len(sentences)} sentences")
+    
+    chunks = [' '.join(sentences[lo:hi]) for lo, hi in _sentence_windows(sentences, chunk_size, overlap)]
     
     logger.info(f"Created {len(chunks)} chunks from text")
     return chunks
 
+def chunk_pages_by_sentences(page_texts: List[Tuple[int, str]], chunk_size: int = 500, overlap: int = 50) -> List[Tuple[int, str]]:
+    """
+    Clean and chunk a whole document in one pass, returning (page_number, chunk) tuples.
+    Cleaned pages are joined into one text so sentences can run across page breaks; each chunk
+    is attributed to the page its first sentence starts on.
+    """
+    page_numbers = []
+    page_starts = []
+    cleaned_pages = []
+    offset = 0
+    for page_num, page_text in page_texts:
+        cleaned_page = clean_text(page_text)
+        if not cleaned_page:
+            continue
+        page_numbers.append(page_num)
+        page_starts.append(offset)
+        cleaned_pages.append(cleaned_page)
+        offset += len(cleaned_page) + 1  # +1 for the joining space
+    
+    if not cleaned_pages:
+        return []
+    
+    text = ' '.join(cleaned_pages)
+    if len(text) <= chunk_size:
+        return [(page_numbers[0], text)]
+    
+    logger.debug(f"Chunking {len(cleaned_pages)} pages ({len(text)} characters) with chunk_size={chunk_size}, overlap={overlap}")
+    # Cleaned text is single-space separated, so sentence k starts at sum(len(s) + 1 for s in sentences[:k])
+    sentences = _SENT_RE.split(text)
+    sentence_starts = [0]
+    sentence_starts.extend(accumulate(len(s) + 1 for s in sentences))
+    
+    page_chunks = []
+    for lo, hi in _sentence_windows(sentences, chunk_size, overlap):
+        page_num = page_numbers[bisect_right(page_starts, sentence_starts[lo]) - 1]
+        page_chunks.append((page_num, ' '.join(sentences[lo:hi])))
+    
+    logger.info(f"Created {len(page_chunks)} chunks from {len(cleaned_pages)} pages")
+    return page_chunks
+
 def create_chunk_with_metadata(chunk: str, source_file: str, chunk_index: int, page_number: int = None) -> Dict:
     """
     Create a chunk dictionary with metadata including page numbers.
@@ -1,14 +1,32 @@
 import streamlit as st
 import requests
+import httpx
+import asyncio
 import os
 import json
+import functools
+import html
 import time
+import orjson
 from datetime import datetime
 from dotenv import load_dotenv
 
 load_dotenv()
 
 API_URL = os.getenv("API_URL", "http://localhost:8000")
+CODE_RENDER_INTERVAL = 0.05  # seconds between streamed code re-renders
+MAX_CONTEXT_EXCHANGES = 10  # previous exchanges sent as conversation context
+
+@st.cache_resource
+def get_http_session():
+    """One keep-alive connection pool to the backend, shared across Streamlit reruns."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+api_session = get_http_session()
 
 # Page configuration
 st.set_page_config(
@@ -23,9 +41,55 @@ if 'conversation_history' not in st.session_state:
     st.session_state.conversation_history = []
 if 'chat_messages' not in st.session_state:
     st.session_state.chat_messages = []
+if 'chat_export_buffer' not in st.session_state:
+    st.session_state.chat_export_buffer = []
+if 'msg_counter' not in st.session_state:
+    st.session_state.msg_counter = 0
+
+@functools.lru_cache(maxsize=1024)
+def format_timestamp(epoch):
+    """Human-readable form of a message's epoch-seconds timestamp, formatted only when displayed."""
+    return datetime.fromtimestamp(epoch).strftime("%Y-%m-%d %H:%M:%S")
+
+def format_sources_html(sources):
+    """Pre-render a message's sources as collapsible source cards in a single HTML block."""
+    cards = []
+    for source in sources:
+        relevance_val = source['relevance_score']
+        if relevance_val >= 0.9:
+            match_label = "🎯 Excellent Match"
+        elif relevance_val >= 0.7:
+            match_label = "✅ Good Match"
+        else:
+            match_label = "⚠️ Moderate Match"
+        # Encode newlines so a blank line in the excerpt can't end the markdown HTML block early
+        excerpt = html.escape(source['excerpt']).replace("\n", "&#10;")
+        cards.append(
+            f'<details class="source-card"><summary class="source-header">'
+            f'📄 {html.escape(source["file"])} - {html.escape(source["location"])} '
+            f'<span class="relevance-badge">{match_label}: {relevance_val:.0%}</span></summary>'
+            f'<pre class="source-excerpt"><code>{excerpt}</code></pre></details>'
+        )
+    return "".join(cards)
+
+def add_chat_message(message):
+    """
+    Append a message to the chat and serialize it once for export, so exporting never re-dumps the whole history.
+    Sources are pre-rendered to HTML here rather than rebuilt as widgets on every rerun.
+    Each message gets a stable integer id for widget keys; 'timestamp' is whole epoch seconds.
+    """
+    st.session_state.msg_counter += 1
+    message['id'] = st.session_state.msg_counter
+    st.session_state.chat_export_buffer.append(json.dumps(message, indent=2))
+    if message.get('sources'):
+        message['_sources_html'] = format_sources_html(message['sources'])
+    st.session_state.chat_messages.append(message)
 
 # Custom CSS for developer-friendly UI with chat interface
-st.markdown("""
+@st.cache_resource
+def _css():
+    """Build the stylesheet once per server process instead of on every rerun."""
+    return """
 <style>
     .main-header {
         font-size: 2.5rem;
@@ -176,7 +240,9 @@ st.markdown("""
         border-color: rgba(102, 126, 234, 0.3);
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(_css(), unsafe_allow_html=True)
 
 # Header
 st.markdown('<div class="main-header">🤖 RAG Coding Assistant</div>', unsafe_allow_html=True)
@@ -204,7 +270,7 @@ with st.sidebar:
         st.metric("Assistant", assistant_msgs)
     
     if st.session_state.conversation_history:
-        st.caption(f"📅 Started: {st.session_state.chat_messages[0]['timestamp'] if st.session_state.chat_messages else 'N/A'}")
+        st.caption(f"📅 Started: {format_timestamp(st.session_state.chat_messages[0]['timestamp']) if st.session_state.chat_messages else 'N/A'}")
     
     st.markdown("---")
     
@@ -237,11 +303,13 @@ with tab1:
     
     if uploaded_files:
         with st.spinner('🔄 Processing documents...'):
-            files = [(f.name, f.read()) for f in uploaded_files]
-            response = requests.post(f"{API_URL}/upload", files=[("files", (name, content)) for name, content in files])
+            # requests reads each file-like UploadedFile into the multipart body itself; rewind them first
+            for f in uploaded_files:
+                f.seek(0)
+            response = api_session.post(f"{API_URL}/upload", files=[("files", (f.name, f, f.type)) for f in uploaded_files])
         
         if response.ok:
-            result = response.json()
+            result = orjson.loads(response.content)
             
             # Success message
             if result.get("status") == "success":
@@ -317,11 +385,12 @@ with tab2:
         if st.button("🗑️ Clear Conversation", help="Start a new conversation"):
             st.session_state.conversation_history = []
             st.session_state.chat_messages = []
+            st.session_state.chat_export_buffer = []
             st.rerun()
     with col2:
         if st.button("💾 Export Chat", help="Download conversation history"):
             if st.session_state.chat_messages:
-                chat_export = json.dumps(st.session_state.chat_messages, indent=2)
+                chat_export = "[\n" + ",\n".join(st.session_state.chat_export_buffer) + "\n]"
                 st.download_button(
                     label="⬇️ Download",
                     data=chat_export,
@@ -339,21 +408,21 @@ with tab2:
     # Chat history display in a scrollable container
     chat_container = st.container()
     
-    with chat_container:
+    @st.fragment
+    def render_history():
+        """Render past messages; widget interactions in here rerun only this fragment, not the whole script."""
         if not st.session_state.chat_messages:
             st.info("👋 **Start a conversation!** Ask me to generate code, explain concepts, or make modifications based on your documentation.")
         else:
             # Display all chat messages
             for msg in st.session_state.chat_messages:
                 if msg['role'] == 'user':
-                    with st.container():
-                        st.markdown("##### 👤 You")
-                        st.markdown(f"*{msg['timestamp']}*")
-                        st.info(msg['content'])
+                    with st.chat_message("user"):
+                        st.write(msg['content'])
+                        st.caption(format_timestamp(msg['timestamp']))
                 else:  # assistant
-                    with st.container():
-                        st.markdown("##### 🤖 Assistant")
-                        st.markdown(f"*{msg['timestamp']}*")
+                    with st.chat_message("assistant"):
+                        st.caption(format_timestamp(msg['timestamp']))
                         
                         # Display code in expandable section for better readability
                         if 'code' in msg and msg['code']:
@@ -364,103 +433,82 @@ with tab2:
                                 st.download_button(
                                     label="⬇️ Download this code",
                                     data=msg['code'],
-                                    file_name=f"code_{msg['timestamp'].replace(':', '-').replace(' ', '_')}.py",
+                                    file_name=f"code_{format_timestamp(msg['timestamp']).replace(':', '-').replace(' ', '_')}.py",
                                     mime="text/plain",
-                                    key=f"download_{msg['timestamp']}"
+                                    key=f"download_{msg['id']}",
+                                    on_click="ignore"
                                 )
                         
                         # Display sources if available
                         if 'sources' in msg and msg['sources']:
                             with st.expander(f"📚 **View Sources** ({len(msg['sources'])} references)", expanded=False):
-                                for source in msg['sources']:
-                                    relevance_pct = f"{source['relevance_score']:.0%}"
-                                    st.markdown(f"**📄 {source['file']} - {source['location']}** ({relevance_pct} match)")
-                                    
-                                    # Relevance indicator
-                                    relevance_val = source['relevance_score']
-                                    if relevance_val >= 0.9:
-                                        st.success(f"🎯 Excellent Match: {relevance_pct}")
-                                    elif relevance_val >= 0.7:
-                                        st.info(f"✅ Good Match: {relevance_pct}")
-                                    else:
-                                        st.warning(f"⚠️ Moderate Match: {relevance_pct}")
-                                    
-                                    with st.expander("View excerpt", expanded=False):
-                                        st.code(source['excerpt'], language=None)
-                                    
-                                    st.markdown("---")
-                        
-                        st.markdown("")  # Spacing
+                                sources_html = msg.get('_sources_html') or format_sources_html(msg['sources'])
+                                st.markdown(sources_html, unsafe_allow_html=True)
     
-    st.markdown("---")
+    with chat_container:
+        render_history()
     
-    # Input section at the bottom (always visible)
-    st.markdown("### 💭 Your Message")
+    st.markdown("---")
     
-    # Use form for better UX
-    with st.form(key="chat_form", clear_on_submit=True):
-        query = st.text_area(
-            "Ask a question or describe what you need...",
-            placeholder="Examples:\n• Create a FastAPI endpoint for user authentication\n• Can you add error handling to the previous code?\n• How would I modify this to use async/await?\n• Explain how the JWT token validation works",
-            height=120,
-            help="Ask follow-up questions naturally - I'll remember our conversation context!"
-        )
-        
-        col1, col2 = st.columns([1, 5])
-        with col1:
-            submit_btn = st.form_submit_button("🚀 Send", type="primary", use_container_width=True)
-        with col2:
-            st.caption("💡 Tip: Ask follow-up questions! I maintain conversation context.")
+    # Input section at the bottom (always visible); chat_input clears itself after submit
+    query = st.chat_input("Ask a question or describe what you need... (follow-ups keep the conversation context)")
     
     # Handle message submission
-    if submit_btn and query:
+    if query:
         # Add user message to chat
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        st.session_state.chat_messages.append({
+        timestamp = int(time.time())
+        add_chat_message({
             'role': 'user',
             'content': query,
             'timestamp': timestamp
         })
         
-        # Build conversation context from history
-        conversation_context = ""
-        for msg in st.session_state.conversation_history:
-            conversation_context += f"User: {msg['query']}\nAssistant: {msg['response'][:500]}...\n\n"
+        # Build conversation context from the most recent exchanges (bounded to keep prompt tokens in check)
+        conversation_context = "".join(
+            msg['_ctx_line'] for msg in st.session_state.conversation_history[-MAX_CONTEXT_EXCHANGES:]
+        )
+        
+        # Show the new exchange in place below the history instead of rerunning the whole script to repaint it
+        with chat_container:
+            with st.chat_message("user"):
+                st.write(query)
+                st.caption(format_timestamp(timestamp))
+            assistant_message = st.chat_message("assistant")
         
         # Create placeholder for streaming response
-        response_placeholder = st.empty()
-        status_placeholder = st.empty()
-        sources_placeholder = st.empty()
+        response_placeholder = assistant_message.empty()
+        status_placeholder = assistant_message.empty()
+        sources_placeholder = assistant_message.empty()
         
-        # Stream the response
-        try:
-            import sseclient
-            import json
-            
-            status_placeholder.info("🤖 Connecting to server...")
-            
-            # Make streaming request
-            response = requests.post(
-                f"{API_URL}/generate-stream",
-                data={
-                    "query": query,
-                    "top_k": top_k,
-                    "conversation_history": conversation_context
-                },
-                stream=True,
-                headers={'Accept': 'text/event-stream'}
-            )
+        async def consume_stream():
+            """Read SSE frames from /generate-stream as they arrive; returns True once the answer is complete."""
+            accumulated_code = ""
+            sources = []
+            # Re-render the code block at most every CODE_RENDER_INTERVAL seconds rather than once per token
+            last_render = time.monotonic()
             
-            if response.ok:
-                accumulated_code = ""
-                sources = []
-                
-                # Parse SSE stream
-                client = sseclient.SSEClient(response)
-                
-                for event in client.events():
-                    try:
-                        data = json.loads(event.data)
+            async with httpx.AsyncClient(timeout=None) as client:
+                async with client.stream(
+                    "POST",
+                    f"{API_URL}/generate-stream",
+                    data={
+                        "query": query,
+                        "top_k": top_k,
+                        "conversation_history": conversation_context
+                    },
+                    headers={'Accept': 'text/event-stream'}
+                ) as response:
+                    if not response.is_success:
+                        st.error(f"❌ Request failed with status {response.status_code}")
+                        return False
+                    
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: "):
+                            continue
+                        try:
+                            data = orjson.loads(line[6:])
+                        except orjson.JSONDecodeError:
+                            continue
                         event_type = data.get('type')
                         
                         if event_type == 'status':
@@ -477,88 +525,44 @@ with tab2:
                         elif event_type == 'code':
                             # Accumulate code chunks and display in real-time
                             accumulated_code += data.get('content', '')
-                            response_placeholder.code(accumulated_code, language="python", line_numbers=True)
+                            if time.monotonic() - last_render >= CODE_RENDER_INTERVAL:
+                                # Line numbers force a full re-layout, so they're only shown on the final render
+                                response_placeholder.code(accumulated_code, language="python")
+                                last_render = time.monotonic()
                         
                         elif event_type == 'done':
-                            status_placeholder.success("✅ " + data.get('message'))
+                            response_placeholder.code(accumulated_code, language="python", line_numbers=True)
+                            completed_at = int(time.time())
+                            status_placeholder.caption(f"✅ {data.get('message')} · {format_timestamp(completed_at)}")
                             
                             # Add final assistant response to chat
-                            st.session_state.chat_messages.append({
+                            add_chat_message({
                                 'role': 'assistant',
                                 'content': 'Generated code based on your documentation',
                                 'code': accumulated_code,
                                 'sources': sources,
-                                'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                                'timestamp': completed_at
                             })
                             
                             # Update conversation history for context
                             st.session_state.conversation_history.append({
                                 'query': query,
                                 'response': accumulated_code[:1000],  # Store first 1000 chars
-                                'timestamp': timestamp
+                                'timestamp': timestamp,
+                                # Prompt-ready line, built once instead of on every submission
+                                '_ctx_line': f"User: {query}\nAssistant: {accumulated_code[:500]}...\n\n"
                             })
-                            
-                            # Clear placeholders and rerun
-                            time.sleep(1)
-                            status_placeholder.empty()
-                            response_placeholder.empty()
-                            sources_placeholder.empty()
-                            st.rerun()
+                            return True
                         
                         elif event_type == 'error':
                             status_placeholder.error(f"❌ Error: {data.get('message')}")
-                            break
-                    
-                    except json.JSONDecodeError:
-                        continue
-            else:
-                st.error(f"❌ Request failed with status {response.status_code}")
-                
-        except ImportError:
-            # Fallback to non-streaming if sseclient is not available
-            st.warning("⚠️ Streaming not available. Install sseclient-py: `pip install sseclient-py`")
-            st.info("Falling back to non-streaming mode...")
-            
-            with st.spinner('🤖 Thinking and generating code...'):
-                try:
-                    response = requests.post(
-                        f"{API_URL}/generate", 
-                        data={
-                            "query": query, 
-                            "top_k": top_k,
-                            "conversation_history": conversation_context
-                        }
-                    )
-                    
-                    if response.ok:
-                        result = response.json()
-                        
-                        if result.get("error") == "no_documents":
-                            st.warning("⚠️ No documents found. Please upload reference documents in the Knowledge Base tab first.")
-                        else:
-                            # Add assistant response to chat
-                            st.session_state.chat_messages.append({
-                                'role': 'assistant',
-                                'content': 'Generated code based on your documentation',
-                                'code': result.get("code", ""),
-                                'sources': result.get("sources", []),
-                                'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            })
-                            
-                            # Update conversation history for context
-                            st.session_state.conversation_history.append({
-                                'query': query,
-                                'response': result.get("code", "")[:1000],  # Store first 1000 chars
-                                'timestamp': timestamp
-                            })
-                            
-                            # Rerun to display new messages
-                            st.rerun()
-                    else:
-                        st.error(f"❌ Request failed with status {response.status_code}")
-                except Exception as e:
-                    st.error(f"❌ Error: {str(e)}")
+                            return False
+            return False
         
+        # Stream the response; the finished answer stays in place and the next rerun draws it from history
+        try:
+            status_placeholder.info("🤖 Connecting to server...")
+            asyncio.run(consume_stream())
         except Exception as e:
             st.error(f"❌ Error: {str(e)}")
 
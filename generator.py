@@ -1,37 +1,68 @@
 import openai
+import aiohttp
 import logging
+from prompt import build_prompt, truncate_context
 
 logger = logging.getLogger(__name__)
 
-def generate_code(context, query, openai_api_key):
-    """Generate code using OpenAI GPT-4 API (non-streaming)."""
+# openai 0.28 opens a fresh aiohttp session (and TLS handshake) per async request unless one is supplied
+_http_session = None
+
+def _get_http_session():
+    """Keep-alive session shared by all async generations on the running event loop."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession()
+    return _http_session
+
+async def close_http_session():
+    """Close the shared session; call on application shutdown."""
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+async def _achat_completion(openai_api_key, **kwargs):
+    # The session is picked up when the request is sent, so the context var only needs to cover this await
+    token = openai.aiosession.set(_get_http_session())
+    try:
+        return await openai.ChatCompletion.acreate(api_key=openai_api_key, **kwargs)
+    finally:
+        openai.aiosession.reset(token)
+
+def generate_code(context, query, openai_api_key, prompt=None):
+    """
+    Generate code using OpenAI GPT-4 API (non-streaming).
+    Pass prompt to send a fully built prompt as-is; otherwise one is built from context (capped
+    at MAX_CONTEXT_TOKENS) and query.
+    """
     logger.info("Starting code generation with GPT-4")
-    logger.debug(f"Context length: {len(context)} characters")
-    logger.debug(f"Query: {query[:100]}...")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Context length: {len(context)} characters, query: {query[:100]}...")
     
-    openai.api_key = openai_api_key
-    prompt = f"Reference:\n{context}\n\nInstruction:\n{query}\n\nGenerate code as per the reference and instruction."
+    if prompt is None:
+        prompt = build_prompt(truncate_context(context), query)
     
     logger.info(f"Sending request to GPT-4 (prompt length: {len(prompt)} characters)")
     response = openai.ChatCompletion.create(
         model="gpt-4",
-        messages=[{"role": "user", "content": prompt}]
+        messages=[{"role": "user", "content": prompt}],
+        api_key=openai_api_key
     )
     
     code = response["choices"][0]["message"]["content"]
     logger.info(f"Received response from GPT-4 (length: {len(code)} characters)")
-    logger.debug(f"Token usage - Prompt: {response['usage']['prompt_tokens']}, Completion: {response['usage']['completion_tokens']}, Total: {response['usage']['total_tokens']}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Token usage - Prompt: {response['usage']['prompt_tokens']}, Completion: {response['usage']['completion_tokens']}, Total: {response['usage']['total_tokens']}")
     
     return code
 
-def generate_code_stream(context, query, openai_api_key):
+def generate_code_stream(context, query, openai_api_key, prompt=None):
     """Generate code using OpenAI GPT-4 API with streaming."""
     logger.info("Starting streaming code generation with GPT-4")
-    logger.debug(f"Context length: {len(context)} characters")
-    logger.debug(f"Query: {query[:100]}...")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Context length: {len(context)} characters, query: {query[:100]}...")
     
-    openai.api_key = openai_api_key
-    prompt = f"Reference:\n{context}\n\nInstruction:\n{query}\n\nGenerate code as per the reference and instruction."
+    if prompt is None:
+        prompt = build_prompt(truncate_context(context), query)
     
     logger.info(f"Sending streaming request to GPT-4 (prompt length: {len(prompt)} characters)")
     
@@ -39,7 +70,8 @@ def generate_code_stream(context, query, openai_api_key):
     response = openai.ChatCompletion.create(
         model="gpt-4",
         messages=[{"role": "user", "content": prompt}],
-        stream=True
+        stream=True,
+        api_key=openai_api_key
     )
     
     # Stream the response
@@ -49,3 +81,41 @@ def generate_code_stream(context, query, openai_api_key):
             yield content
     
     logger.info("Streaming code generation completed")
+
+async def agenerate_code(context, query, openai_api_key, prompt=None):
+    """Async variant of generate_code; awaits the completion on the event loop instead of blocking a thread."""
+    logger.info("Starting async code generation with GPT-4")
+    if prompt is None:
+        prompt = build_prompt(truncate_context(context), query)
+    
+    logger.info(f"Sending request to GPT-4 (prompt length: {len(prompt)} characters)")
+    response = await _achat_completion(
+        openai_api_key,
+        model="gpt-4",
+        messages=[{"role": "user", "content": prompt}]
+    )
+    
+    code = response["choices"][0]["message"]["content"]
+    logger.info(f"Received response from GPT-4 (length: {len(code)} characters)")
+    return code
+
+async def agenerate_code_stream(context, query, openai_api_key, prompt=None):
+    """Async variant of generate_code_stream; yields content deltas as they arrive."""
+    logger.info("Starting async streaming code generation with GPT-4")
+    if prompt is None:
+        prompt = build_prompt(truncate_context(context), query)
+    
+    logger.info(f"Sending streaming request to GPT-4 (prompt length: {len(prompt)} characters)")
+    response = await _achat_completion(
+        openai_api_key,
+        model="gpt-4",
+        messages=[{"role": "user", "content": prompt}],
+        stream=True
+    )
+    
+    async for chunk in response:
+        content = chunk["choices"][0].get("delta", {}).get("content")
+        if content:
+            yield content
+    
+    logger.info("Streaming code generation completed")
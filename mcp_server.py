@@ -3,6 +3,7 @@
 
 import asyncio
 import json
+import sys
 from typing import Any
 import os
 from dotenv import load_dotenv
@@ -18,8 +19,8 @@ except ImportError:
     print("⚠️  MCP not installed. Run: pip install mcp")
 
 # Your existing RAG components
-from qdrant_utils import get_qdrant_client, search_documents_with_metadata
-from embedder import get_embedding
+from qdrant_utils import get_qdrant_client, collection_exists, search_documents_with_metadata, get_document_chunks
+from embedder import get_query_embedding
 
 load_dotenv()
 
@@ -37,6 +38,19 @@ def get_client():
         qdrant_client = get_qdrant_client(QDRANT_URL, QDRANT_API_KEY)
     return qdrant_client
 
+_SEPARATOR = "=" * 60
+
+def _iter_formatted_results(results):
+    """Yield the lines of the search_knowledge_base response for Copilot."""
+    yield f"Found {len(results)} relevant sources:\n"
+    for i, result in enumerate(results, 1):
+        page_info = f"Page {result['page_number']}" if result['page_number'] else f"Section {result['chunk_index']}"
+        yield "\n" + _SEPARATOR
+        yield f"Source {i}: {result['source']} - {page_info} ({result['score']:.0%} match)"
+        yield _SEPARATOR
+        yield result['text']
+        yield ""
+
 # Create MCP server
 if MCP_AVAILABLE:
     server = Server("rag-knowledge-base")
@@ -108,12 +122,14 @@ if MCP_AVAILABLE:
             top_k = arguments.get("top_k", 5)
             
             try:
-                # Generate embedding for query
-                query_embedding = get_embedding(query, OPENAI_API_KEY)
+                # Generate embedding for query (repeated queries are served from the in-process LRU)
+                # Blocking calls run on worker threads so concurrent tool calls aren't serialized on the event loop
+                query_embedding = await asyncio.to_thread(get_query_embedding, query, OPENAI_API_KEY)
                 
                 # Search Qdrant
                 client = get_client()
-                results = search_documents_with_metadata(
+                results = await asyncio.to_thread(
+                    search_documents_with_metadata,
                     client, 
                     COLLECTION_NAME, 
                     query_embedding, 
@@ -127,22 +143,9 @@ if MCP_AVAILABLE:
                     )]
                 
                 # Format results for Copilot
-                formatted_results = []
-                formatted_results.append(f"Found {len(results)} relevant sources:\n")
-                
-                for i, result in enumerate(results, 1):
-                    page_info = f"Page {result['page_number']}" if result['page_number'] else f"Section {result['chunk_index']}"
-                    relevance = f"{result['score']:.0%}"
-                    
-                    formatted_results.append(f"\n{'='*60}")
-                    formatted_results.append(f"Source {i}: {result['source']} - {page_info} ({relevance} match)")
-                    formatted_results.append(f"{'='*60}")
-                    formatted_results.append(result['text'])
-                    formatted_results.append("")
-                
                 return [types.TextContent(
                     type="text",
-                    text="\n".join(formatted_results)
+                    text="\n".join(_iter_formatted_results(results))
                 )]
                 
             except Exception as e:
@@ -157,18 +160,8 @@ if MCP_AVAILABLE:
             try:
                 client = get_client()
                 
-                # Search for all chunks from this file
-                # We use a broad query and filter by source
-                query_embedding = get_embedding("content", OPENAI_API_KEY)
-                results = search_documents_with_metadata(
-                    client,
-                    COLLECTION_NAME,
-                    query_embedding,
-                    limit=1000  # Get many results
-                )
-                
-                # Filter by filename
-                file_chunks = [r for r in results if r['source'] == filename]
+                # Fetch all chunks from this file by payload filter (already sorted by chunk index)
+                file_chunks = await asyncio.to_thread(get_document_chunks, client, COLLECTION_NAME, filename)
                 
                 if not file_chunks:
                     return [types.TextContent(
@@ -176,8 +169,6 @@ if MCP_AVAILABLE:
                         text=f"File '{filename}' not found in knowledge base."
                     )]
                 
-                # Sort by chunk index and combine
-                file_chunks.sort(key=lambda x: x['chunk_index'])
                 full_content = "\n\n".join(chunk['text'] for chunk in file_chunks)
                 
                 return [types.TextContent(
@@ -202,15 +193,26 @@ async def main():
     Run the MCP server.
     GitHub Copilot will connect to this server to access your knowledge base.
     """
+    # stdout carries the MCP JSON-RPC stream, so status messages go to stderr
     if not MCP_AVAILABLE:
-        print("❌ MCP not installed. Install with: pip install mcp")
+        print("❌ MCP not installed. Install with: pip install mcp", file=sys.stderr)
         return
     
-    print("🚀 Starting RAG Knowledge Base MCP Server...")
-    print(f"📚 Collection: {COLLECTION_NAME}")
-    print(f"🔗 Qdrant URL: {QDRANT_URL}")
-    print("✅ Server ready for GitHub Copilot connections")
-    print("\nConfigure in VS Code settings.json:")
+    print("🚀 Starting RAG Knowledge Base MCP Server...", file=sys.stderr)
+    print(f"📚 Collection: {COLLECTION_NAME}", file=sys.stderr)
+    print(f"🔗 Qdrant URL: {QDRANT_URL}", file=sys.stderr)
+    
+    # Connect to Qdrant up front so the first tool call doesn't pay the channel setup
+    try:
+        client = await asyncio.to_thread(get_client)
+        if await asyncio.to_thread(collection_exists, client, COLLECTION_NAME):
+            print("✅ Qdrant connection established", file=sys.stderr)
+        else:
+            print(f"⚠️  Collection '{COLLECTION_NAME}' not found - upload documents first", file=sys.stderr)
+    except Exception as e:
+        print(f"⚠️  Qdrant health check failed: {e}", file=sys.stderr)
+    print("✅ Server ready for GitHub Copilot connections", file=sys.stderr)
+    print("\nConfigure in VS Code settings.json:", file=sys.stderr)
     print('''
 {
   "github.copilot.advanced": {
@@ -224,7 +226,7 @@ async def main():
     }
   }
 }
-    ''')
+    ''', file=sys.stderr)
     
     async with stdio_server() as (read_stream, write_stream):
         await server.run(
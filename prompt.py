@@ -1,13 +1,56 @@
 import os
+import io
 import logging
+import functools
+from string import Template
 from dotenv import load_dotenv
+try:
+    import tiktoken
+    TIKTOKEN_SUPPORT = True
+except ImportError:
+    TIKTOKEN_SUPPORT = False
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-# Template for code generation prompt
-CODE_PROMPT_TEMPLATE = """
+# Token budget for retrieved reference text in a generation prompt
+MAX_CONTEXT_TOKENS = 6000
+
+# Fixed grounding rules, kept as a constant prefix so every request shares the same prompt head
+STRICT_PROMPT_RULES = """You are a precise code generation assistant. You MUST follow these rules strictly:
+
+1. ONLY use information from the provided reference documents
+2. DO NOT add any information not present in the references
+3. If the references don't contain enough information, say "The provided documentation does not contain sufficient information for..."
+4. When generating code, cite which source number [Source N] you're using
+5. Include comments in code indicating which source the logic comes from
+6. If this is a follow-up question, consider the previous conversation context but still ground responses in the reference documents
+"""
+
+STRICT_PROMPT_TEMPLATE = Template(STRICT_PROMPT_RULES + """
+${history_context}
+Reference Documents:
+${context}
+
+User Query:
+${query}
+
+Instructions:
+- Generate code based ONLY on the reference documents above
+- Add comments like "# Based on Source 1: filename.pdf - Page X"
+- If multiple approaches are mentioned in different sources, mention all of them
+- If information is missing, explicitly state what's missing
+- Include inline citations in comments
+- For follow-up questions, maintain context from the previous conversation while staying grounded in the documents
+
+Generate the code with citations:""")
+
+def build_prompt(context, query):
+    """
+    Build the prompt for code generation using retrieved context and user query.
+    """
+    prompt = f"""
 Reference:
 {context}
 
@@ -20,12 +63,63 @@ Output Requirements:
 - If relevant, add usage examples.
 - Output only code, no explanations unless requested.
 """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Built prompt ({len(prompt)} characters) from context length {len(context)}, query length {len(query)}")
+    return prompt
 
-def build_prompt(context, query):
+@functools.lru_cache(maxsize=1)
+def _get_encoding():
+    """Load the GPT-4 tokenizer on first use; None if tiktoken or its BPE file is unavailable."""
+    if not TIKTOKEN_SUPPORT:
+        return None
+    try:
+        return tiktoken.encoding_for_model("gpt-4")
+    except Exception as e:
+        logger.warning(f"Tokenizer unavailable, capping context by characters: {e}")
+        return None
+
+def truncate_context(context, max_tokens=MAX_CONTEXT_TOKENS):
     """
-    Build the prompt for code generation using retrieved context and user query.
+    Cap reference context at max_tokens. Sources are ordered by relevance, so the tail is dropped.
+    Without a tokenizer, falls back to ~4 characters per token.
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        max_chars = max_tokens * 4
+        if len(context) <= max_chars:
+            return context
+        truncated = context[:max_chars].rstrip()
+    else:
+        tokens = encoding.encode(context)
+        if len(tokens) <= max_tokens:
+            return context
+        truncated = encoding.decode(tokens[:max_tokens]).rstrip()
+    logger.info(f"Truncated context from {len(context)} to {len(truncated)} characters ({max_tokens} token budget)")
+    return truncated
+
+def build_context(search_results):
+    """
+    Build the reference context from search results, tagging each chunk with a [Source N] citation marker.
+    Writes into a single buffer rather than joining a list of intermediate f-strings.
+    """
+    buf = io.StringIO()
+    for i, result in enumerate(search_results, 1):
+        if i > 1:
+            buf.write("\n\n---\n\n")
+        page_info = f"Page {result['page_number']}" if result['page_number'] else f"Chunk {result['chunk_index']}"
+        buf.write(f"[Source {i}: {result['source']} - {page_info}]\n")
+        buf.write(result['text'])
+    context = buf.getvalue()
+    logger.debug(f"Built context from {len(search_results)} sources ({len(context)} characters)")
+    return context
+
+def build_strict_prompt(context, query, conversation_history=""):
+    """
+    Build the strict anti-hallucination prompt used by /generate and /generate-stream.
     """
-    logger.debug(f"Building prompt with context length: {len(context)}, query length: {len(query)}")
-    prompt = CODE_PROMPT_TEMPLATE.format(context=context, query=query)
-    logger.debug(f"Generated prompt length: {len(prompt)}")
+    history_context = ""
+    if conversation_history.strip():
+        history_context = f"Previous Conversation Context:\n{conversation_history}\n\n"
+    prompt = STRICT_PROMPT_TEMPLATE.substitute(history_context=history_context, context=context, query=query)
+    logger.debug(f"Built strict prompt ({len(prompt)} characters)")
     return prompt
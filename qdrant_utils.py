@@ -1,12 +1,66 @@
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import PointStruct, Distance, VectorParams
-from qdrant_client.http.exceptions import UnexpectedResponse
+from qdrant_client.http.models import (
+    PointStruct, Distance, VectorParams, QueryRequest,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType,
+    SearchParams, QuantizationSearchParams, Datatype,
+    Filter, FieldCondition, MatchValue, PayloadSchemaType, OptimizersConfigDiff, HnswConfigDiff
+)
+import os
 import logging
+import weakref
+import functools
+import itertools
+import numpy as np
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 logger = logging.getLogger(__name__)
 
-def get_qdrant_client(url, api_key):
-    """Initialize Qdrant client with longer timeout."""
+# Protobuf over a persistent HTTP/2 channel avoids JSON-encoding every vector
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() == "true"
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+
+UPLOAD_BATCH_SIZE = 256
+# Uploads smaller than this aren't worth the worker-process startup cost
+PARALLEL_UPLOAD_MIN_POINTS = 2000
+MAX_UPLOAD_WORKERS = 4
+MAX_UPLOAD_THREADS = 8
+# Qdrant's default indexing threshold (KB of vectors per segment before HNSW is built)
+INDEXING_THRESHOLD = 20000
+
+# Collections each client has already seen exist, so searches skip the get_collection round-trip
+_verified_collections = weakref.WeakKeyDictionary()
+
+# Payload fields the result dicts are built from; "length" and anything else stays on the server
+RESULT_PAYLOAD_FIELDS = ["text", "source", "chunk_index", "page_number"]
+
+# Denser HNSW graph than Qdrant's defaults (m=16, ef_construct=100): better recall per query-time hop
+HNSW_M = 32
+HNSW_EF_CONSTRUCT = 256
+
+# Search the quantized index, then rescore top_k * oversampling candidates with the original vectors
+RESCORE_OVERSAMPLING = 2.0
+SEARCH_HNSW_EF = 128
+
+def quantized_search_params(oversampling=RESCORE_OVERSAMPLING):
+    """Search params that pin the HNSW beam width and how many quantized candidates are rescored."""
+    return SearchParams(
+        hnsw_ef=SEARCH_HNSW_EF,
+        quantization=QuantizationSearchParams(ignore=False, rescore=True, oversampling=oversampling)
+    )
+
+QUANTIZED_SEARCH_PARAMS = quantized_search_params()
+
+@functools.lru_cache(maxsize=4)
+def get_qdrant_client(url, api_key, prefer_grpc=None):
+    """
+    Initialize Qdrant client with longer timeout.
+    Uses the gRPC transport (QDRANT_GRPC_PORT) unless prefer_grpc=False or QDRANT_PREFER_GRPC=false.
+    Clients are cached per (url, api_key, prefer_grpc), so repeated calls reuse the open connection;
+    call get_qdrant_client.cache_clear() after closing one.
+    """
+    if prefer_grpc is None:
+        prefer_grpc = QDRANT_PREFER_GRPC
     logger.info(f"Initializing Qdrant client with URL: {url}")
     
     # Suppress version compatibility warnings
@@ -14,110 +68,248 @@ def get_qdrant_client(url, api_key):
     warnings.filterwarnings('ignore', message='.*Qdrant client version.*incompatible.*')
     
     if api_key:
-        client = QdrantClient(url=url, api_key=api_key, timeout=120)
-        logger.info("Qdrant client initialized with API key and 120s timeout")
+        client = QdrantClient(url=url, api_key=api_key, timeout=120, prefer_grpc=prefer_grpc, grpc_port=QDRANT_GRPC_PORT)
+        logger.info(f"Qdrant client initialized with API key and 120s timeout (gRPC: {prefer_grpc})")
     else:
-        client = QdrantClient(url=url, timeout=120)
-        logger.info("Qdrant client initialized without API key and 120s timeout")
+        client = QdrantClient(url=url, timeout=120, prefer_grpc=prefer_grpc, grpc_port=QDRANT_GRPC_PORT)
+        logger.info(f"Qdrant client initialized without API key and 120s timeout (gRPC: {prefer_grpc})")
     return client
 
 def collection_exists(client, collection_name):
     """Check if collection exists."""
     logger.debug(f"Checking if collection '{collection_name}' exists")
-    try:
-        client.get_collection(collection_name)
-        logger.debug(f"Collection '{collection_name}' exists")
+    exists = client.collection_exists(collection_name)
+    logger.debug(f"Collection '{collection_name}' {'exists' if exists else 'does not exist'}")
+    return exists
+
+def _collection_verified(client, collection_name):
+    """collection_exists, remembering positive answers for the lifetime of the client."""
+    verified = _verified_collections.setdefault(client, set())
+    if collection_name in verified:
+        return True
+    if collection_exists(client, collection_name):
+        verified.add(collection_name)
         return True
-    except UnexpectedResponse:
-        logger.debug(f"Collection '{collection_name}' does not exist")
-        return False
+    return False
 
-def create_collection(client, collection_name, vector_size):
-    """Create or recreate collection."""
-    logger.info(f"Creating collection '{collection_name}' with vector size {vector_size}")
+def create_collection(client, collection_name, vector_size, hnsw_m=HNSW_M, hnsw_ef_construct=HNSW_EF_CONSTRUCT, hnsw_on_disk=False):
+    """
+    Create or recreate collection.
+    Vectors are scalar-quantized to int8 (clipping the outer 1% of values) and kept in RAM;
+    the originals live on disk as float16 and are only read for rescoring.
+    hnsw_on_disk keeps the HNSW graph on disk too, for corpora whose graph doesn't fit in RAM.
+    """
+    logger.info(f"Creating collection '{collection_name}' with vector size {vector_size} (HNSW m={hnsw_m}, ef_construct={hnsw_ef_construct})")
     if collection_exists(client, collection_name):
         logger.info(f"Collection '{collection_name}' already exists, deleting it")
+        _verified_collections.get(client, set()).discard(collection_name)
         client.delete_collection(collection_name)
     client.create_collection(
         collection_name=collection_name,
-        vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE)
+        vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE, on_disk=True, datatype=Datatype.FLOAT16),
+        hnsw_config=HnswConfigDiff(m=hnsw_m, ef_construct=hnsw_ef_construct, on_disk=hnsw_on_disk),
+        quantization_config=ScalarQuantization(
+            scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+        ),
+        # Defer HNSW building until the bulk upload is done; the upload functions re-enable it
+        optimizers_config=OptimizersConfigDiff(indexing_threshold=0)
     )
+    # Keyword index so per-file lookups (get_document_chunks) are an indexed filter rather than a scan;
+    # the integer index does the same for chunk ranges within a file
+    client.create_payload_index(collection_name, field_name="source", field_schema=PayloadSchemaType.KEYWORD)
+    client.create_payload_index(collection_name, field_name="chunk_index", field_schema=PayloadSchemaType.INTEGER)
+    _verified_collections.setdefault(client, set()).add(collection_name)
     logger.info(f"Collection '{collection_name}' created successfully")
 
 def upload_documents(client, collection_name, docs, embeddings):
-    """Upload documents and embeddings to Qdrant."""
-    points = [
-        PointStruct(id=i, vector=embeddings[i], payload={"text": docs[i]})
-        for i in range(len(docs))
-    ]
-    client.upsert(collection_name=collection_name, points=points)
+    """
+    Upload documents and embeddings to Qdrant.
+    Used from the Streamlit app, where spawning upload worker processes isn't practical, so batches are
+    upserted concurrently from a thread pool instead; the calls are network-bound and overlap well.
+    The last batch is sent with wait=True, so all points are searchable when this returns.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float16)
+    batches = []
+    for start_idx in range(0, len(docs), UPLOAD_BATCH_SIZE):
+        # One array-to-list conversion per batch instead of one per vector
+        batch_vectors = embeddings[start_idx:start_idx + UPLOAD_BATCH_SIZE].tolist()
+        batches.append([
+            PointStruct(id=start_idx + j, vector=vector, payload={"text": docs[start_idx + j]})
+            for j, vector in enumerate(batch_vectors)
+        ])
+    if batches:
+        *bulk, last = batches
+        if bulk:
+            with ThreadPoolExecutor(max_workers=min(MAX_UPLOAD_THREADS, len(bulk))) as executor:
+                futures = [
+                    executor.submit(client.upsert, collection_name=collection_name, points=points, wait=False)
+                    for points in bulk
+                ]
+                for future in as_completed(futures):
+                    future.result()
+        # Qdrant applies updates in order, so once this waited upsert returns every earlier batch is visible too
+        client.upsert(collection_name=collection_name, points=last, wait=True)
+    _enable_indexing(client, collection_name)
 
-def upload_documents_with_metadata(client, collection_name, chunk_objs, embeddings):
-    """Upload documents with metadata to Qdrant in batches to avoid timeouts."""
-    total_docs = len(chunk_objs)
-    logger.info(f"Uploading {total_docs} documents to collection '{collection_name}'")
+def upload_documents_with_metadata(client, collection_name, chunk_objs, embeddings, expected_count=None):
+    """
+    Upload documents with metadata to Qdrant. embeddings may be an (n, dim) array or a list of lists;
+    it is converted to float16, the datatype the collection stores.
+    chunk_objs and embeddings may also be iterators of equal length, in which case they are consumed
+    one batch at a time and the corpus never has to be held in memory; pass expected_count for large
+    streams so they can use parallel workers (streams of unknown size upload from this process).
+    Vectors, payloads and ids go to upload_collection column-wise, so each batch is sent as a single
+    models.Batch rather than one validated PointStruct per chunk; large uploads are spread over several
+    worker processes. Each batch waits until Qdrant has applied it, so every point is searchable when this
+    returns. HNSW indexing is re-enabled once everything is in.
+    """
+    total_docs = len(chunk_objs) if hasattr(chunk_objs, "__len__") else expected_count
+    if total_docs is None or total_docs < PARALLEL_UPLOAD_MIN_POINTS:
+        parallel = 1
+    else:
+        parallel = min(os.cpu_count() or 1, MAX_UPLOAD_WORKERS)
+    logger.info(f"Uploading {total_docs if total_docs is not None else 'streamed'} documents to collection "
+                f"'{collection_name}' (batch size {UPLOAD_BATCH_SIZE}, {parallel} worker(s))")
+    
+    if hasattr(embeddings, "__len__"):
+        # Halves the array handed to upload workers; the server rounds to float16 anyway
+        vectors = np.asarray(embeddings, dtype=np.float16)
+    else:
+        vectors = (np.asarray(v, dtype=np.float16).tolist() for v in embeddings)
     
-    # Upload in batches of 100 to avoid timeout
-    batch_size = 100
-    total_batches = (total_docs + batch_size - 1) // batch_size
+    uploaded = 0
+    def iter_payloads():
+        nonlocal uploaded
+        # Chunk metadata (source, chunk_index, length and page_number when known) is stored alongside the text
+        for c in chunk_objs:
+            uploaded += 1
+            yield {"text": c["text"], **c["metadata"]}
     
-    for batch_num in range(total_batches):
-        start_idx = batch_num * batch_size
-        end_idx = min((batch_num + 1) * batch_size, total_docs)
-        
-        logger.info(f"Uploading batch {batch_num + 1}/{total_batches} ({end_idx - start_idx} points)")
-        
-        batch_points = [
-            PointStruct(
-                id=i, 
-                vector=embeddings[i], 
-                payload={
-                    "text": chunk_objs[i]["text"],
-                    "source": chunk_objs[i]["metadata"]["source"],
-                    "chunk_index": chunk_objs[i]["metadata"]["chunk_index"],
-                    "length": chunk_objs[i]["metadata"]["length"]
-                }
-            )
-            for i in range(start_idx, end_idx)
-        ]
-        
-        client.upsert(collection_name=collection_name, points=batch_points)
+    try:
+        client.upload_collection(
+            collection_name=collection_name,
+            vectors=vectors,
+            payload=iter_payloads(),
+            ids=itertools.count(),
+            batch_size=UPLOAD_BATCH_SIZE,
+            parallel=parallel,
+            # upload_collection defaults to fire-and-forget; callers search right after uploading
+            wait=True
+        )
+    finally:
+        _enable_indexing(client, collection_name)
     
-    logger.info(f"Successfully uploaded {total_docs} points to Qdrant in {total_batches} batch(es)")
+    logger.info(f"Successfully uploaded {uploaded} points to Qdrant")
 
+def _enable_indexing(client, collection_name):
+    """Turn HNSW indexing back on after a bulk load into a collection created with indexing deferred."""
+    client.update_collection(
+        collection_name=collection_name,
+        optimizers_config=OptimizersConfigDiff(indexing_threshold=INDEXING_THRESHOLD)
+    )
+    logger.info(f"Re-enabled indexing on '{collection_name}' (threshold {INDEXING_THRESHOLD})")
 
 def search_documents(client, collection_name, query_embedding, top_k=3):
     """Search for similar documents. Returns only text (legacy)."""
     results_with_metadata = search_documents_with_metadata(client, collection_name, query_embedding, top_k)
     return [r['text'] for r in results_with_metadata]
 
-def search_documents_with_metadata(client, collection_name, query_embedding, top_k=3):
-    """Search for similar documents and return full metadata."""
+def search_documents_with_metadata(client, collection_name, query_embedding, top_k=3, oversampling=None):
+    """
+    Search for similar documents and return full metadata.
+    oversampling overrides RESCORE_OVERSAMPLING for this search.
+    """
     logger.info(f"Searching collection '{collection_name}' for top {top_k} documents")
-    if not collection_exists(client, collection_name):
+    if not _collection_verified(client, collection_name):
         logger.warning(f"Collection '{collection_name}' does not exist")
         return []
     
     results = client.search(
         collection_name=collection_name,
         query_vector=query_embedding,
-        limit=top_k
+        limit=top_k,
+        search_params=QUANTIZED_SEARCH_PARAMS if oversampling is None else quantized_search_params(oversampling),
+        with_payload=RESULT_PAYLOAD_FIELDS,
+        with_vectors=False
     )
     
     logger.info(f"Found {len(results)} relevant documents")
+    return _format_results(results)
+
+def search_documents_with_metadata_batch(client, collection_name, query_embeddings, top_k=3, oversampling=None):
+    """
+    Search for several query vectors in a single round-trip.
+    Returns one list of results (same shape as search_documents_with_metadata) per query, in input order.
+    """
+    logger.info(f"Batch searching collection '{collection_name}' with {len(query_embeddings)} queries for top {top_k} documents each")
+    if not _collection_verified(client, collection_name):
+        logger.warning(f"Collection '{collection_name}' does not exist")
+        return [[] for _ in query_embeddings]
+    
+    params = QUANTIZED_SEARCH_PARAMS if oversampling is None else quantized_search_params(oversampling)
+    requests = [
+        QueryRequest(query=vector, limit=top_k, with_payload=RESULT_PAYLOAD_FIELDS, params=params)
+        for vector in query_embeddings
+    ]
+    responses = client.query_batch_points(collection_name=collection_name, requests=requests)
     
-    formatted_results = []
-    for i, r in enumerate(results, 1):
-        result_data = {
+    logger.info(f"Batch search returned {sum(len(r.points) for r in responses)} results")
+    return [_format_results(response.points) for response in responses]
+
+def get_document_chunks(client, collection_name, source, page_size=1000):
+    """
+    Fetch every chunk of one source file with a payload-filtered scroll; no query embedding is needed.
+    Returns result dicts sorted by chunk_index.
+    """
+    logger.info(f"Fetching all chunks of '{source}' from collection '{collection_name}'")
+    if not _collection_verified(client, collection_name):
+        logger.warning(f"Collection '{collection_name}' does not exist")
+        return []
+    
+    source_filter = Filter(must=[FieldCondition(key="source", match=MatchValue(value=source))])
+    chunks = []
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=source_filter,
+            limit=page_size,
+            offset=offset,
+            with_payload=RESULT_PAYLOAD_FIELDS,
+            with_vectors=False
+        )
+        chunks.extend(
+            {
+                'text': p.payload['text'],
+                'source': p.payload.get('source', 'Unknown'),
+                'chunk_index': p.payload.get('chunk_index', 0),
+                'page_number': p.payload.get('page_number')
+            }
+            for p in points
+        )
+        if offset is None:
+            break
+    
+    chunks.sort(key=itemgetter('chunk_index'))
+    logger.info(f"Found {len(chunks)} chunks for '{source}'")
+    return chunks
+
+def _format_results(results):
+    """Convert scored points into result dicts. Scores are left unrounded; callers format them for display."""
+    formatted_results = [
+        {
             'text': r.payload['text'],
             'source': r.payload.get('source', 'Unknown'),
             'chunk_index': r.payload.get('chunk_index', 0),
             'page_number': r.payload.get('page_number'),
-            'score': round(r.score, 4)
+            'score': r.score
         }
-        formatted_results.append(result_data)
-        
-        page_info = f"page {result_data['page_number']}" if result_data['page_number'] else f"chunk {result_data['chunk_index']}"
-        logger.debug(f"Result {i}: score={r.score:.4f}, source={result_data['source']}, {page_info}")
+        for r in results
+    ]
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, result_data in enumerate(formatted_results, 1):
+            page_info = f"page {result_data['page_number']}" if result_data['page_number'] else f"chunk {result_data['chunk_index']}"
+            logger.debug(f"Result {i}: score={result_data['score']:.4f}, source={result_data['source']}, {page_info}")
     
     return formatted_results
@@ -5,6 +5,9 @@ Interactive RAG CLI - Query your knowledge base without typing the full command
 
 import sys
 import os
+import asyncio
+import openai
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,13 +15,46 @@ load_dotenv()
 # Add project root to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from embedder import get_embedding
-from qdrant_utils import get_qdrant_client, search_documents_with_metadata
+from embedder import get_query_embedding, aget_query_embeddings
+from qdrant_utils import get_qdrant_client, collection_exists, search_documents_with_metadata, search_documents_with_metadata_batch
+from chunk_cache import SearchResultCache
 
 QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 COLLECTION_NAME = "reference_docs"
+# Set by --rescore-oversampling; None keeps qdrant_utils.RESCORE_OVERSAMPLING
+RESCORE_OVERSAMPLING = None
+USAGE = """Usage:
+  python rag_cli.py [--rescore-oversampling N]                      interactive mode
+  python rag_cli.py [--rescore-oversampling N] <question>           single query
+  python rag_cli.py [--rescore-oversampling N] --queries-file FILE  one query per line"""
+
+# Queries per embedding call / batch search in --queries-file mode
+QUERY_GROUP_SIZE = 100
+
+# Near-duplicate questions (cosine >= 0.97) reuse recent results instead of searching again
+result_cache = SearchResultCache(max_entries=512, threshold=0.97)
+
+
+def print_results(results):
+    """Print search results with their source, chunk and match percentage"""
+    for i, result in enumerate(results, 1):
+        relevance_pct = int(result['score'] * 100)
+        
+        print("=" * 70)
+        print(f"Result {i}: {result['source']} - Chunk {result['chunk_index']} ({relevance_pct}% match)")
+        print("=" * 70)
+        print(result['text'])
+        print()
+
+
+def _warm_openai_connection():
+    """Open the HTTPS connection to OpenAI with a free model-list request; failures surface on the first real query instead"""
+    try:
+        openai.Model.list(api_key=OPENAI_API_KEY)
+    except Exception:
+        pass
 
 
 def search_interactive():
@@ -31,11 +67,24 @@ def search_interactive():
     # Initialize connection once
     try:
         client = get_qdrant_client(QDRANT_URL, QDRANT_API_KEY)
-        print("✓ Connected to Qdrant\n")
+        # Opens the connection now instead of on the first query
+        has_collection = collection_exists(client, COLLECTION_NAME)
+        if has_collection:
+            points = client.count(COLLECTION_NAME, exact=False).count
     except Exception as e:
         print(f"❌ Error connecting to Qdrant: {e}")
         return
     
+    if not has_collection:
+        print(f"❌ Collection '{COLLECTION_NAME}' not created yet - upload documents first")
+        return
+    print(f"✓ Connected to Qdrant ({points} chunks indexed)\n")
+    
+    # openai keeps one HTTP session per thread, so all embedding calls go through one worker thread
+    # whose connection is opened while the user types the first question
+    embed_executor = ThreadPoolExecutor(max_workers=1)
+    embed_executor.submit(_warm_openai_connection)
+    
     while True:
         try:
             # Get query from user
@@ -53,30 +102,28 @@ def search_interactive():
             print(f"\n🔍 Searching for: '{query}'")
             print()
             
-            # Generate embedding
-            query_embedding = get_embedding(query, OPENAI_API_KEY)
+            # Generate embedding (repeated questions are served from the LRU)
+            query_embedding = embed_executor.submit(get_query_embedding, query, OPENAI_API_KEY).result()
             
-            # Search documents
-            results = search_documents_with_metadata(
-                client, 
-                COLLECTION_NAME, 
-                query_embedding, 
-                top_k=5
-            )
+            # Search documents, unless a near-identical question was answered within the last minute
+            results = result_cache.get(query_embedding, 5)
+            if results is None:
+                results = search_documents_with_metadata(
+                    client, 
+                    COLLECTION_NAME, 
+                    query_embedding, 
+                    top_k=5,
+                    oversampling=RESCORE_OVERSAMPLING
+                )
+                if results:
+                    result_cache.put(query_embedding, 5, results)
             
             if not results:
                 print("❌ No results found. Try a different query.\n")
                 continue
             
             # Display results
-            for i, result in enumerate(results, 1):
-                relevance_pct = int(result['score'] * 100)
-                
-                print("=" * 70)
-                print(f"Result {i}: {result['source']} - Chunk {result['chunk_index']} ({relevance_pct}% match)")
-                print("=" * 70)
-                print(result['text'])
-                print()
+            print_results(results)
             
             print("=" * 70)
             print()
@@ -86,6 +133,8 @@ def search_interactive():
             break
         except Exception as e:
             print(f"\n❌ Error: {e}\n")
+    
+    embed_executor.shutdown(wait=False, cancel_futures=True)
 
 
 def search_once(query):
@@ -94,35 +143,107 @@ def search_once(query):
     
     try:
         client = get_qdrant_client(QDRANT_URL, QDRANT_API_KEY)
-        query_embedding = get_embedding(query, OPENAI_API_KEY)
+        query_embedding = get_query_embedding(query, OPENAI_API_KEY)
         results = search_documents_with_metadata(
             client, 
             COLLECTION_NAME, 
             query_embedding, 
-            top_k=5
+            top_k=5,
+            oversampling=RESCORE_OVERSAMPLING
         )
         
         if not results:
             print("❌ No results found.")
             return
         
-        for i, result in enumerate(results, 1):
-            relevance_pct = int(result['score'] * 100)
-            
-            print("=" * 70)
-            print(f"Result {i}: {result['source']} - Chunk {result['chunk_index']} ({relevance_pct}% match)")
-            print("=" * 70)
-            print(result['text'])
-            print()
+        print_results(results)
+        
+    except Exception as e:
+        print(f"❌ Error: {e}")
+
+
+async def _search_groups(client, queries):
+    """Yield (query, results) pairs, embedding each group of queries while the previous group is being searched"""
+    pending = None
+    for start in range(0, len(queries), QUERY_GROUP_SIZE):
+        group = queries[start:start + QUERY_GROUP_SIZE]
+        query_embeddings = await aget_query_embeddings(group, OPENAI_API_KEY)
+        if pending:
+            prev_group, search_task = pending
+            for item in zip(prev_group, await search_task):
+                yield item
+        search_task = asyncio.create_task(asyncio.to_thread(
+            search_documents_with_metadata_batch,
+            client, 
+            COLLECTION_NAME, 
+            query_embeddings.tolist(), 
+            5,
+            RESCORE_OVERSAMPLING
+        ))
+        pending = (group, search_task)
+    if pending:
+        prev_group, search_task = pending
+        for item in zip(prev_group, await search_task):
+            yield item
+
+
+async def _print_search_groups(client, queries):
+    async for query, results in _search_groups(client, queries):
+        print(f"\n📝 {query}\n")
+        if not results:
+            print("❌ No results found.\n")
+            continue
+        print_results(results)
+
+
+def search_from_file(queries_file):
+    """Batch mode - run every query in a file (one per line), one batched embedding call and search round-trip per group"""
+    try:
+        with open(queries_file, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    except OSError as e:
+        print(f"❌ Error reading {queries_file}: {e}")
+        return
+    
+    if not queries:
+        print(f"❌ No queries found in {queries_file}")
+        return
+    
+    print(f"🔍 Searching for {len(queries)} queries from '{queries_file}'\n")
+    
+    try:
+        client = get_qdrant_client(QDRANT_URL, QDRANT_API_KEY)
+        asyncio.run(_print_search_groups(client, queries))
         
     except Exception as e:
         print(f"❌ Error: {e}")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
+    args = sys.argv[1:]
+    if args and args[0] == "--rescore-oversampling":
+        # Quantized candidates rescored per result: higher is more accurate, lower is faster
+        try:
+            RESCORE_OVERSAMPLING = float(args[1])
+            if RESCORE_OVERSAMPLING < 1:
+                raise ValueError
+        except (IndexError, ValueError):
+            print("❌ --rescore-oversampling needs a number >= 1")
+            print(USAGE)
+            sys.exit(1)
+        args = args[2:]
+    
+    if args and args[0] == "--queries-file" and len(args) != 2:
+        print("❌ --queries-file needs exactly one file path")
+        print(USAGE)
+        sys.exit(1)
+    
+    if len(args) == 2 and args[0] == "--queries-file":
+        # Batch mode
+        search_from_file(args[1])
+    elif args:
         # Single query mode
-        query = " ".join(sys.argv[1:])
+        query = " ".join(args)
         search_once(query)
     else:
         # Interactive mode